@@ -1,15 +1,32 @@
 # -*- coding: utf-8 -*-
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import itertools
+import multiprocessing
+
 import numpy as np
 from dipy.reconst.shm import sh_to_sf_matrix
 from dipy.data import get_sphere
 from dipy.core.sphere import Sphere
-from scipy.ndimage import correlate
+
+# Offsets to the first neighbors of a voxel, their norm and the
+# corresponding unit directions (null for the center voxel)
+NEIGHBOR_OFFSETS = np.stack(np.meshgrid([-1, 0, 1], [-1, 0, 1], [-1, 0, 1],
+                                        indexing='ij'), axis=-1).astype(float)
+NEIGHBOR_NORMS = np.linalg.norm(NEIGHBOR_OFFSETS, axis=-1, keepdims=True)
+NEIGHBOR_DIRECTIONS = np.divide(NEIGHBOR_OFFSETS, NEIGHBOR_NORMS,
+                                out=np.zeros_like(NEIGHBOR_OFFSETS),
+                                where=NEIGHBOR_NORMS > 0)
+NEIGHBOR_OFFSETS.setflags(write=False)
+NEIGHBOR_NORMS.setflags(write=False)
+NEIGHBOR_DIRECTIONS.setflags(write=False)
 
 
 def local_asym_filtering(in_sh, sh_order=8, sh_basis='descoteaux07',
                          in_full_basis=False, dot_sharpness=1.0,
-                         sphere_str='repulsion724', sigma=1.0):
+                         sphere_str='repulsion724', sigma=1.0,
+                         nbr_processes=None, dtype=np.float32):
     """Average the SH projected on a sphere using a first-neighbor gaussian
     blur and a dot product weight between sphere directions and the direction
     to neighborhood voxels, forcing to 0 negative values and thus performing
@@ -33,21 +50,152 @@ def local_asym_filtering(in_sh, sh_order=8, sh_basis='descoteaux07',
     sphere_str: str, optional
         Name of the sphere used to project SH coefficients to SF.
     sigma: float, optional
-        Sigma for the Gaussian.
+        Sigma for the Gaussian. The filter support is always restricted to
+        the first neighbors (3x3x3), whatever the value of sigma.
+    nbr_processes: int, optional
+        The number of threads used to filter slabs of the volume in
+        parallel.
+        Default: multiprocessing.cpu_count()
+    dtype: data-type, optional
+        Data type used for intermediate computations. Single precision is
+        sufficient for filtering and halves memory usage.
 
     Returns
     -------
     out_sh: ndarray (x, y, z, n_coeffs)
         Filtered signal as SH coefficients in full SH basis.
     """
-    # Load the sphere used for projection of SH
-    sphere = get_sphere(sphere_str)
-
     # Normalized filter for each sf direction
-    weights = _get_weights(sphere, dot_sharpness, sigma)
+    weights = _get_cached_weights(sphere_str, dot_sharpness, sigma)
+
+    # SH to SF projection matrices on the sphere and on the inverse sphere
+    # and SF to full SH basis matrix
+    B, neg_B, B_inv = _get_sh_to_sf_matrices(sphere_str, sh_order,
+                                             sh_basis, in_full_basis)
+    nb_sf = B.shape[-1]
+
+    # All computations are done using the requested data type
+    B = B.astype(dtype, copy=False)
+    neg_B = neg_B.astype(dtype, copy=False)
+    B_inv = B_inv.astype(dtype, copy=False)
+    weights = weights.astype(dtype, copy=False)
+
+    # Project SH on the sphere and on the inverse sphere for all vertices
+    # at once, using a single matrix product for each. The input is made
+    # C-contiguous so that tensordot flattens it without a hidden copy. The
+    # layout of the (small) projection matrices is left as is, BLAS handles
+    # transposed operands without copying them.
+    in_sh_c = np.ascontiguousarray(in_sh, dtype=dtype)
+    curr_sf = np.tensordot(in_sh_c, B, axes=([-1], [0]))
+
+    # Split the filter between the center voxel and its neighbors
+    center_w = weights[1, 1, 1].copy()
+    neighbor_w = weights.copy()
+    neighbor_w[1, 1, 1] = 0.0
+    neighbor_w = neighbor_w.reshape((-1, nb_sf))
+
+    if in_full_basis:
+        opp_sf = np.tensordot(in_sh_c, neg_B, axes=([-1], [0]))
+
+        # Calculate contribution of center voxel. The projection on the
+        # sphere is not needed afterwards, so its buffer is reused.
+        mean_sf = np.multiply(curr_sf, center_w, out=curr_sf)
+    else:
+        # A symmetric SH basis only contains even orders, for which
+        # Y(-v) = Y(v). Then neg_B == B and the SF on the opposite
+        # hemisphere is the SF itself, so the second projection is skipped.
+        opp_sf = curr_sf
+
+        # Calculate contribution of center voxel
+        mean_sf = curr_sf * center_w
 
-    nb_sf = len(sphere.vertices)
-    mean_sf = np.zeros(np.append(in_sh.shape[:-1], nb_sf))
+    # Add contributions of neighbors using opposite hemispheres. The
+    # correlation is applied to all sphere vertices at once by summing the
+    # shifted volume of each neighbor, weighted per vertice.
+    # The volume is split in slabs along its first axis, filtered in
+    # parallel threads. Each thread writes to its own contiguous slab of
+    # the output and only reads the neighboring slices of the input.
+    nbr_processes = multiprocessing.cpu_count() \
+        if nbr_processes is None or nbr_processes <= 0 \
+        else nbr_processes
+    x_dim = mean_sf.shape[0]
+    bounds = np.linspace(0, x_dim, min(nbr_processes, x_dim) + 1, dtype=int)
+    with ThreadPoolExecutor(max_workers=len(bounds) - 1) as executor:
+        list(executor.map(
+            lambda start, end: _correlate_neighbors(opp_sf, neighbor_w,
+                                                    mean_sf, start, end),
+            bounds[:-1], bounds[1:]))
+
+    # Convert back to SH coefficients
+    out_sh = np.tensordot(mean_sf, B_inv, axes=([-1], [0]))
+    return out_sh.astype(in_sh.dtype, copy=False)
+
+
+def _correlate_neighbors(opp_sf, neighbor_w, out, x_start, x_end):
+    """
+    Add to `out[x_start:x_end]` the correlation of the SF volume with the
+    neighbors weights, for each sphere vertice. Voxels outside the volume
+    are considered null, which is done by only adding the overlapping part
+    of the shifted volume instead of padding it. Only the slab
+    `opp_sf[x_start - 1:x_end + 1]` is read.
+
+    Parameters
+    ----------
+    opp_sf: ndarray (x, y, z, nb_sf)
+        SF on the opposite hemisphere.
+    neighbor_w: ndarray (27, nb_sf)
+        Flattened neighbors weights, with null weights for the center voxel.
+    out: ndarray (x, y, z, nb_sf)
+        Output array, modified in place.
+    x_start: int
+        First index of the slab of `out` to update along the first axis.
+    x_end: int
+        End index (excluded) of the slab of `out` to update.
+    """
+    # Buffer for the weighted neighbor, reused for all offsets
+    tmp = np.empty_like(out[x_start:x_end])
+    bounds = [(x_start, x_end)] + [(0, n) for n in out.shape[1:-1]]
+    for offset, w in zip(itertools.product((-1, 0, 1), repeat=3),
+                         neighbor_w):
+        if not w.any():
+            continue
+        dst = [(max(start, -o), min(end, n - o))
+               for o, (start, end), n in zip(offset, bounds, out.shape)]
+        src = tuple(slice(lo + o, hi + o) for o, (lo, hi) in zip(offset, dst))
+        tmp_dst = (slice(dst[0][0] - x_start, dst[0][1] - x_start),) +\
+            tuple(slice(lo, hi) for lo, hi in dst[1:])
+        dst = tuple(slice(lo, hi) for lo, hi in dst)
+        np.multiply(opp_sf[src], w, out=tmp[tmp_dst])
+        np.add(out[dst], tmp[tmp_dst], out=out[dst])
+
+
+@lru_cache(maxsize=8)
+def _get_sh_to_sf_matrices(sphere_str, sh_order, sh_basis, in_full_basis):
+    """
+    Get the SH to SF projection matrices used for filtering. Results are
+    cached and returned as read-only arrays.
+
+    Parameters
+    ----------
+    sphere_str: str
+        Name of the sphere used to project SH coefficients to SF.
+    sh_order: int
+        Maximum order of the SH series.
+    sh_basis: {'descoteaux07', 'tournier07'}
+        SH basis of the input signal.
+    in_full_basis: bool
+        True if the input is in full SH basis.
+
+    Returns
+    -------
+    B: ndarray (n_coeffs, nb_sf)
+        SH to SF matrix for the sphere.
+    neg_B: ndarray (n_coeffs, nb_sf)
+        SH to SF matrix for the inverse sphere.
+    B_inv: ndarray (nb_sf, n_coeffs_full)
+        SF to full SH basis matrix.
+    """
+    sphere = get_sphere(sphere_str)
     B = sh_to_sf_matrix(sphere, sh_order=sh_order, basis_type=sh_basis,
                         return_inv=False, full_basis=in_full_basis)
 
@@ -57,26 +205,24 @@ def local_asym_filtering(in_sh, sh_order=8, sh_basis='descoteaux07',
                             basis_type=sh_basis, return_inv=False,
                             full_basis=in_full_basis)
 
-    # Apply filter to each sphere vertice
-    for sf_i in range(nb_sf):
-        w_filter = weights[..., sf_i]
-
-        # Calculate contribution of center voxel
-        current_sf = np.dot(in_sh, B[:, sf_i])
-        mean_sf[..., sf_i] = w_filter[1, 1, 1] * current_sf
-
-        # Add contributions of neighbors using opposite hemispheres
-        current_sf = np.dot(in_sh, neg_B[:, sf_i])
-        w_filter[1, 1, 1] = 0.0
-        mean_sf[..., sf_i] += correlate(current_sf, w_filter, mode="constant")
-
-    # Convert back to SH coefficients
     _, B_inv = sh_to_sf_matrix(sphere, sh_order=sh_order,
                                basis_type=sh_basis,
                                full_basis=True)
 
-    out_sh = np.array([np.dot(i, B_inv) for i in mean_sf], dtype=in_sh.dtype)
-    return out_sh
+    for matrix in (B, neg_B, B_inv):
+        matrix.setflags(write=False)
+    return B, neg_B, B_inv
+
+
+@lru_cache(maxsize=8)
+def _get_cached_weights(sphere_str, dot_sharpness, sigma):
+    """
+    Cached version of `_get_weights` taking the name of the sphere as
+    argument. The returned weights are read-only.
+    """
+    weights = _get_weights(get_sphere(sphere_str), dot_sharpness, sigma)
+    weights.setflags(write=False)
+    return weights
 
 
 def _get_weights(sphere, dot_sharpness, sigma):
@@ -97,29 +243,18 @@ def _get_weights(sphere, dot_sharpness, sigma):
     weights: dictionary
         Vertices weights with respect to voxel directions.
     """
-    directions = np.zeros((3, 3, 3, 3))
-    for x in range(3):
-        for y in range(3):
-            for z in range(3):
-                directions[x, y, z, 0] = x - 1
-                directions[x, y, z, 1] = y - 1
-                directions[x, y, z, 2] = z - 1
-
-    non_zero_dir = np.ones((3, 3, 3), dtype=bool)
-    non_zero_dir[1, 1, 1] = False
-
-    # normalize dir
-    dir_norm = np.linalg.norm(directions, axis=-1, keepdims=True)
-    directions[non_zero_dir] /= dir_norm[non_zero_dir]
-
-    g_weights = np.exp(-dir_norm**2 / (2 * sigma**2))
-    d_weights = np.dot(directions, sphere.vertices.T)
-
-    d_weights = np.where(d_weights > 0.0, d_weights**dot_sharpness, 0.0)
-    weights = d_weights * g_weights
+    g_weights = np.exp(-NEIGHBOR_NORMS**2 / (2 * sigma**2))
+    d_weights = (NEIGHBOR_DIRECTIONS.reshape((-1, 3)) @ sphere.vertices.T)
+    d_weights = d_weights.reshape((3, 3, 3, -1))
+
+    # Clip negative dot products to 0 and apply the sharpness, the gaussian
+    # weighting and the center weight in place on the same array
+    weights = np.clip(d_weights, 0.0, None, out=d_weights)
+    np.power(weights, dot_sharpness, out=weights, where=weights > 0.0)
+    weights *= g_weights
     weights[1, 1, 1, :] = 1.0
 
     # Normalize filters so that all sphere directions weights sum to 1
-    weights /= weights.reshape((-1, weights.shape[-1])).sum(axis=0)
+    weights /= weights.sum(axis=(0, 1, 2), keepdims=True)
 
     return weights
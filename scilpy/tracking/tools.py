@@ -116,11 +116,8 @@ def resample_streamlines_num_points(sft, num_points):
     if num_points <= 1:
         raise ValueError("The value of num_points should be greater than 1!")
 
-    # Resampling
-    resampled_streamlines = []
-    for streamline in sft.streamlines:
-        line = set_number_of_points(streamline, num_points)
-        resampled_streamlines.append(line)
+    # Resampling all streamlines at once, directly on the ArraySequence
+    resampled_streamlines = set_number_of_points(sft.streamlines, num_points)
 
     # Creating sft
     # CAREFUL. Data_per_point will be lost.
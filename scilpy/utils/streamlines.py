@@ -754,26 +754,34 @@ def upsample_tractogram(
     # Get the number of streamlines to add
     nb_new = nb - len(sft.streamlines)
 
-    # Get the streamlines that will serve as a base for new ones
+    # Get the streamlines that will serve as a base for new ones. Copying
+    # them gives a single contiguous buffer holding all their points, kept
+    # in double precision until the new streamlines are smoothed.
     indices = rng.choice(
         len(sft.streamlines), nb_new)
     new_streamlines = sft.streamlines.copy()
-
-    # For all selected streamlines, add noise and smooth
-    for s in sft.streamlines[indices]:
-        if point_wise_std:
-            noise = rng.normal(scale=point_wise_std, size=s.shape)
-        elif streamline_wise_std:
-            noise = rng.normal(
-                scale=streamline_wise_std, size=s.shape[-1])
-        new_s = s + noise
-        if gaussian:
-            new_s = smooth_line_gaussian(new_s, gaussian)
-        elif spline:
-            new_s = smooth_line_spline(new_s, spline[0],
-                                       spline[1])
-
-        new_streamlines.append(new_s)
+    noisy_streamlines = sft.streamlines[indices].copy()
+    noisy_streamlines._data = noisy_streamlines._data.astype(np.float64)
+
+    # Add noise to all selected streamlines at once
+    data = noisy_streamlines._data
+    if point_wise_std:
+        noise = rng.normal(scale=point_wise_std, size=data.shape)
+    elif streamline_wise_std:
+        noise = rng.normal(scale=streamline_wise_std,
+                           size=(len(noisy_streamlines), data.shape[-1]))
+        noise = np.repeat(noise, noisy_streamlines._lengths, axis=0)
+    data += noise
+
+    # Smooth the new streamlines
+    if gaussian:
+        noisy_streamlines = [smooth_line_gaussian(s, gaussian)
+                             for s in noisy_streamlines]
+    elif spline:
+        noisy_streamlines = [smooth_line_spline(s, spline[0], spline[1])
+                             for s in noisy_streamlines]
+
+    new_streamlines.extend(noisy_streamlines)
 
     new_sft = StatefulTractogram.from_sft(new_streamlines, sft)
     return new_sft
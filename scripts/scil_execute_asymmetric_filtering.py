@@ -9,6 +9,8 @@ Sphere directions are also weighted by their dot product with the direction
 to the center of each neighbor, clipping to 0 negative values.
 
 The argument `sigma` controls the standard deviation of the Gaussian. The
+filter is always restricted to the first neighbors (3x3x3 voxels), increasing
+`sigma` only gives more weight to neighbors relative to the center voxel. The
 argument `sharpness` controls the exponent of the cosine weights. The higher it
 is, the faster the weights of misaligned sphere directions decrease. A
 sharpness of 0 gives the same weight to all sphere directions in an hemisphere.
@@ -66,6 +68,10 @@ def _build_arg_parser():
     p.add_argument('--sigma', default=1.0, type=float,
                    help='Sigma of the gaussian to use. [%(default)s]')
 
+    p.add_argument('--processes', dest='nbr_processes', metavar='NBR',
+                   type=int, default=1,
+                   help='Number of threads used for filtering. [%(default)s]')
+
     add_verbose_arg(p)
     add_overwrite_arg(p)
 
@@ -95,7 +101,8 @@ def main():
         in_full_basis=full_basis,
         sphere_str=args.sphere,
         dot_sharpness=args.sharpness,
-        sigma=args.sigma)
+        sigma=args.sigma,
+        nbr_processes=args.nbr_processes)
 
     logging.info('Saving filtered SH to file {0}.'.format(args.out_sh))
     nib.save(nib.Nifti1Image(filtered_sh, sh_img.affine), args.out_sh)
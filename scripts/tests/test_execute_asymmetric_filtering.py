@@ -50,3 +50,15 @@ def test_asym_input(script_runner):
     ret = script_runner.run('scil_execute_asymmetric_filtering.py', in_fodf,
                             'out_2.nii.gz', '--sphere', 'repulsion100', '-f')
     assert ret.success
+
+
+def test_multithreaded(script_runner):
+    os.chdir(os.path.expanduser(tmp_dir.name))
+    in_fodf = os.path.join(get_home(), 'processing',
+                           'fodf_descoteaux07_sub.nii.gz')
+
+    # We use a low resolution sphere to reduce execution time
+    ret = script_runner.run('scil_execute_asymmetric_filtering.py', in_fodf,
+                            'out_3.nii.gz', '--sphere', 'repulsion100',
+                            '--processes', '2')
+    assert ret.success